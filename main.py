@@ -5,14 +5,19 @@ Provides tools for creating, viewing, and exporting OpenSCAD models
 """
 
 import asyncio
+import atexit
 import base64
+import hashlib
 import json
 import logging
 import os
+import shutil
 import subprocess
-import tempfile
+import time
+from collections import OrderedDict
+from contextlib import suppress
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Literal, Sequence, get_args
 
 from fastmcp import FastMCP
 
@@ -32,10 +37,33 @@ SERVER_DIR = Path(__file__).parent
 WORK_DIR = Path(os.getenv('OPENSCAD_WORK_DIR', SERVER_DIR))
 WORK_DIR.mkdir(exist_ok=True)
 
-STATE_FILE = WORK_DIR / 'scratchpad_state.json'
+# Largest script accepted into the scratchpad, in UTF-8 bytes
+MAX_SCRIPT_BYTES = int(os.getenv('OPENSCAD_MAX_SCRIPT', 1 << 20))
+
+# Scratchpad is stored as plain SCAD plus a sidecar hash so loading needs no parsing
+SCRIPT_FILE = WORK_DIR / 'scratchpad.scad'
+HASH_FILE = WORK_DIR / 'scratchpad.sha256'
+LEGACY_STATE_FILE = WORK_DIR / 'scratchpad_state.json'
+
+# Bursts of script updates are coalesced into a single state write
+SAVE_DEBOUNCE_SECONDS = 0.1
+
+# Rendered PNGs are memoized by (script hash, view, size), in memory and on disk
+RenderKey = tuple[str, str, int]
+RENDER_CACHE_DIR = WORK_DIR / '.render_cache'
+RENDER_CACHE_SIZE = 32
+_RENDER_CACHE: OrderedDict[RenderKey, str] = OrderedDict()
+
+# Renders currently running, so identical concurrent requests share one process
+_INFLIGHT: Dict[RenderKey, asyncio.Future[str]] = {}
+
+# Resolve the OpenSCAD executable once instead of searching PATH on every spawn
+OPENSCAD_BIN = shutil.which('openscad') or 'openscad'
 
 # Predefined camera views for OpenSCAD
-CAMERA_VIEWS = {
+CameraView = Literal['isometric', 'front', 'back', 'left', 'right', 'top', 'bottom']
+
+CAMERA_VIEWS: Dict[CameraView, str] = {
     'isometric': '--camera=10,10,10,60,0,45,25',
     'front': '--camera=0,0,10,0,0,0,25',
     'back': '--camera=0,0,-10,0,0,180,25',
@@ -45,36 +73,237 @@ CAMERA_VIEWS = {
     'bottom': '--camera=0,0,-10,0,0,0,25'
 }
 
+# Global $fn set for preview-quality STL exports
+PREVIEW_FN = 32
+
+# Square image sizes offered for renders
+RenderSize = Literal[256, 512, 768, 1024, 2048]
+
+# Full OpenSCAD render arguments per (view, size), built once at import
+_RENDER_ARGS: Dict[tuple[CameraView, RenderSize], tuple[str, ...]] = {
+    (view, size): (camera, f'--imgsize={size},{size}', '--render',
+                   '--export-format=png', '-o', '-', '-')
+    for view, camera in CAMERA_VIEWS.items()
+    for size in get_args(RenderSize)
+}
+
 class OpenSCADState:
     """Manages the persistent scratchpad state"""
     
     def __init__(self):
         self.script_content = ""
+        self.script_hash = _script_hash("")
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
         self.load_state()
+        atexit.register(self.flush_state)
     
     def load_state(self):
-        """Load state from JSON file"""
+        """Load state from the scratchpad files"""
         try:
-            if STATE_FILE.exists():
-                with open(STATE_FILE, 'r') as f:
-                    data = json.load(f)
-                    self.script_content = data.get('script_content', '')
+            if SCRIPT_FILE.exists():
+                script_stat = SCRIPT_FILE.stat()
+                self.script_content = SCRIPT_FILE.read_bytes().decode('utf-8')
+                self.script_hash = _read_hash_sidecar(script_stat) or _script_hash(self.script_content)
                 logger.info("State loaded from file")
+            elif LEGACY_STATE_FILE.exists():
+                with open(LEGACY_STATE_FILE, 'r') as f:
+                    data = json.load(f)
+                self.script_content = data.get('script_content', '')
+                self.script_hash = _script_hash(self.script_content)
+                self._dirty = True
+                logger.info("State migrated from %s", LEGACY_STATE_FILE)
             else:
                 logger.info("No existing state file, starting fresh")
         except Exception as e:
-            logger.error(f"Error loading state: {e}")
+            logger.error("Error loading state: %s", e)
             self.script_content = ""
+            self.script_hash = _script_hash("")
     
     def save_state(self):
-        """Save current state to JSON file"""
+        """Schedule a debounced save, or save immediately outside an event loop"""
+        self._dirty = True
         try:
-            data = {'script_content': self.script_content}
-            with open(STATE_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_state()
+            return
+        
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(SAVE_DEBOUNCE_SECONDS, self.flush_state)
+    
+    def flush_state(self):
+        """Atomically write pending state to the scratchpad files"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        
+        try:
+            # Drop the hash first so a crash mid-save can't pair it with a newer script
+            HASH_FILE.unlink(missing_ok=True)
+            _atomic_write(SCRIPT_FILE, self.script_content.encode('utf-8'))
+            # Record which version of the script file the hash describes
+            script_stat = SCRIPT_FILE.stat()
+            sidecar = f"{self.script_hash} {script_stat.st_size} {script_stat.st_mtime_ns}\n"
+            _atomic_write(HASH_FILE, sidecar.encode('ascii'))
+            self._dirty = False
             logger.info("State saved to file")
         except Exception as e:
-            logger.error(f"Error saving state: {e}")
+            logger.error("Error saving state: %s", e)
+
+def _read_hash_sidecar(script_stat: os.stat_result) -> Optional[str]:
+    """Return the stored script hash if it still matches the script file
+    
+    The sidecar records the script's size and mtime alongside the digest, so
+    a scratchpad edited by hand while the server was stopped gets rehashed.
+    """
+    try:
+        digest, size, mtime_ns = HASH_FILE.read_text().split()
+        size, mtime_ns = int(size), int(mtime_ns)
+    except (FileNotFoundError, ValueError):
+        return None
+    if size != script_stat.st_size or mtime_ns != script_stat.st_mtime_ns:
+        logger.info("Scratchpad changed since last save, rehashing")
+        return None
+    return digest
+
+def _atomic_write(path: Path, data: bytes):
+    """Write data to a sibling temp file and rename it over path"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _line_count(text: str) -> int:
+    """Count lines without splitting the text into a list"""
+    return text.count('\n') + (0 if text.endswith('\n') else 1)
+
+def _script_hash(script_content: str) -> str:
+    """Return the sha256 hex digest of a script, used to key cached renders"""
+    return hashlib.sha256(script_content.encode('utf-8')).hexdigest()
+
+def _png_data_uri(png_data: bytes) -> str:
+    """Encode PNG bytes as a data URI, decoding to str only once at the end"""
+    return (b'data:image/png;base64,' + base64.b64encode(png_data)).decode('ascii')
+
+def _render_cache_path(key: RenderKey) -> Path:
+    """Return the on-disk location of a cached render"""
+    script_hash, view, size = key
+    return RENDER_CACHE_DIR / f"{script_hash}_{view}_{size}.png"
+
+def _remember_render(key: RenderKey, data_uri: str):
+    """Insert a render into the in-memory LRU, evicting the oldest entry"""
+    _RENDER_CACHE[key] = data_uri
+    _RENDER_CACHE.move_to_end(key)
+    while len(_RENDER_CACHE) > RENDER_CACHE_SIZE:
+        _RENDER_CACHE.popitem(last=False)
+
+def _read_cached_png(key: RenderKey) -> Optional[bytearray]:
+    """Read a cached PNG from disk, or None if it is missing or truncated"""
+    cache_path = _render_cache_path(key)
+    try:
+        # Unbuffered reads straight into an exactly sized buffer
+        with open(cache_path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            buf = bytearray(size)
+            read = 0
+            with memoryview(buf) as view:
+                while read < size:
+                    n = f.readinto(view[read:])
+                    if not n:
+                        break
+                    read += n
+        if read != size:
+            logger.warning("Ignoring truncated cached render %s", cache_path)
+            return None
+        return buf
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Failed to read cached render %s: %s", cache_path, e)
+        return None
+
+def _write_cached_png(key: RenderKey, png_data: bytes):
+    """Write a PNG to the on-disk cache and prune the oldest files"""
+    try:
+        RENDER_CACHE_DIR.mkdir(exist_ok=True)
+        _atomic_write(_render_cache_path(key), png_data)
+        
+        # Keep the on-disk cache bounded like the in-memory one
+        cached_files = []
+        for entry in os.scandir(RENDER_CACHE_DIR):
+            if not entry.name.endswith('.png'):
+                continue
+            with suppress(OSError):
+                cached_files.append((entry.stat().st_mtime, entry.path))
+        cached_files.sort()
+        for _, stale_path in cached_files[:-RENDER_CACHE_SIZE]:
+            with suppress(OSError):
+                os.unlink(stale_path)
+    except Exception as e:
+        logger.warning("Failed to persist cached render: %s", e)
+
+async def get_cached_render(key: RenderKey) -> Optional[str]:
+    """Look up a render in memory, falling back to the on-disk cache
+    
+    Disk access runs in a worker thread so it never stalls the event loop.
+    """
+    data_uri = _RENDER_CACHE.get(key)
+    if data_uri is not None:
+        _RENDER_CACHE.move_to_end(key)
+        return data_uri
+    
+    png_data = await asyncio.to_thread(_read_cached_png, key)
+    if png_data is None:
+        return None
+    
+    data_uri = _png_data_uri(png_data)
+    _remember_render(key, data_uri)
+    return data_uri
+
+async def store_cached_render(key: RenderKey, png_data: bytes, data_uri: str):
+    """Store a render in memory and persist the PNG so restarts keep it"""
+    _remember_render(key, data_uri)
+    await asyncio.to_thread(_write_cached_png, key, png_data)
+
+# Bound the number of OpenSCAD processes running at once
+_OPENSCAD_SLOTS = asyncio.Semaphore(os.cpu_count() or 1)
+
+async def run_openscad(args: Sequence[str], timeout: float,
+                       input: Optional[bytes] = None) -> subprocess.CompletedProcess:
+    """Run a single OpenSCAD invocation without blocking the event loop
+    
+    OpenSCAD handles one job per process, so every render and export goes
+    through here. If given, input is piped to stdin (pass '-' as the input
+    file). stdout is returned as raw bytes, stderr as text. On timeout the
+    process is killed and reaped before subprocess.TimeoutExpired is raised,
+    so no zombies are left behind.
+    """
+    cmd = [OPENSCAD_BIN, *args]
+    async with _OPENSCAD_SLOTS:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Running OpenSCAD command: %s", ' '.join(cmd))
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, stdout, stderr.decode('utf-8', errors='replace')
+    )
 
 # Global state instance
 state = OpenSCADState()
@@ -90,7 +319,7 @@ def show_openscad_script() -> str:
             return "No script content in scratchpad"
         return f"Current OpenSCAD script:\n\n{state.script_content}"
     except Exception as e:
-        logger.error(f"Error showing script: {e}")
+        logger.error("Error showing script: %s", e)
         return f"Error retrieving script: {e}"
 
 @mcp.tool()
@@ -101,141 +330,145 @@ def create_openscad_script(script_content: str) -> str:
         script_content: The OpenSCAD script content
     """
     try:
+        if len(script_content.encode('utf-8')) > MAX_SCRIPT_BYTES:
+            return f"Script too large (>{MAX_SCRIPT_BYTES} bytes)"
+        
+        lines = _line_count(script_content)
+        chars = len(script_content)
+        if script_content == state.script_content:
+            return f"OpenSCAD script unchanged ({lines} lines, {chars} characters)"
+        
+        _RENDER_CACHE.clear()
         state.script_content = script_content
+        state.script_hash = _script_hash(script_content)
         state.save_state()
-        lines = len(script_content.split('\n'))
-        chars = len(script_content)
-        logger.info(f"Script updated: {lines} lines, {chars} characters")
+        logger.info("Script updated: %d lines, %d characters", lines, chars)
         return f"OpenSCAD script updated successfully ({lines} lines, {chars} characters)"
     except Exception as e:
-        logger.error(f"Error creating script: {e}")
+        logger.error("Error creating script: %s", e)
         return f"Error updating script: {e}"
 
+async def _render_png(cache_key: RenderKey, script_content: str) -> str:
+    """Render a script to a PNG data URI and cache it, or return an error message"""
+    _, view, size = cache_key
+    try:
+        render_args = _RENDER_ARGS[view, size]
+    except KeyError:
+        if view not in CAMERA_VIEWS:
+            return f"Invalid view '{view}'. Available views: {', '.join(CAMERA_VIEWS.keys())}"
+        return f"Invalid size {size}. Available sizes: {', '.join(map(str, get_args(RenderSize)))}"
+    
+    # Pipe the script in on stdin and read the PNG back from stdout
+    result = await run_openscad(
+        render_args, timeout=30, input=script_content.encode('utf-8')
+    )
+    
+    if result.returncode != 0:
+        error_msg = f"OpenSCAD error: {result.stderr}"
+        logger.error(error_msg)
+        return error_msg
+    
+    png_data = result.stdout
+    if not png_data:
+        return "Render failed: No output generated"
+    
+    data_uri = _png_data_uri(png_data)
+    await store_cached_render(cache_key, png_data, data_uri)
+    
+    logger.info("Render successful: %s view, %dpx, %d bytes data URI", view, size, len(data_uri))
+    return data_uri
+
 @mcp.tool()
-def view_render(view: str = "isometric") -> str:
+async def view_render(view: CameraView = "isometric", size: RenderSize = 512) -> str:
     """Render the current OpenSCAD script and return as base64 PNG
     
+    Smaller images render faster and are much cheaper to transfer; use 256
+    or 512 while iterating and 1024 or larger only for final checks.
+    
     Args:
         view: Camera view - options: isometric, front, back, left, right, top, bottom
+        size: Image width and height in pixels - options: 256, 512, 768, 1024, 2048
     """
     try:
-        if not state.script_content.strip():
+        # Snapshot the script so edits made while rendering don't leak in
+        script_content, script_hash = state.script_content, state.script_hash
+        if not script_content.strip():
             return "No script content to render"
         
-        if view not in CAMERA_VIEWS:
-            return f"Invalid view '{view}'. Available views: {', '.join(CAMERA_VIEWS.keys())}"
+        cache_key = (script_hash, view, size)
+        cached = await get_cached_render(cache_key)
+        if cached is not None:
+            logger.info("Render cache hit: %s view, %dpx", view, size)
+            return cached
         
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.scad', delete=False) as scad_file:
-            scad_file.write(state.script_content)
-            scad_path = scad_file.name
+        render = _INFLIGHT.get(cache_key)
+        if render is None:
+            render = asyncio.ensure_future(_render_png(cache_key, script_content))
+            _INFLIGHT[cache_key] = render
+            render.add_done_callback(lambda _: _INFLIGHT.pop(cache_key, None))
+        else:
+            logger.info("Joining in-flight render: %s view, %dpx", view, size)
         
-        png_path = scad_path.replace('.scad', '.png')
+        # Shield so one caller disconnecting doesn't cancel the render for the others
+        return await asyncio.shield(render)
         
-        try:
-            # Run OpenSCAD to generate PNG
-            cmd = [
-                'openscad',
-                CAMERA_VIEWS[view],
-                '--imgsize=1024,1024',
-                '--render',
-                '-o', png_path,
-                scad_path
-            ]
-            
-            logger.info(f"Running OpenSCAD command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            
-            if result.returncode != 0:
-                error_msg = f"OpenSCAD error: {result.stderr}"
-                logger.error(error_msg)
-                return error_msg
-            
-            # Read and encode the PNG
-            if not Path(png_path).exists():
-                return "Render failed: No output file generated"
-            
-            with open(png_path, 'rb') as f:
-                png_data = f.read()
-            
-            base64_data = base64.b64encode(png_data).decode('utf-8')
-            
-            logger.info(f"Render successful: {view} view, {len(base64_data)} bytes base64")
-            return f"data:image/png;base64,{base64_data}"
-            
-        finally:
-            # Cleanup temporary files
-            for temp_path in [scad_path, png_path]:
-                try:
-                    if Path(temp_path).exists():
-                        os.unlink(temp_path)
-                except Exception as e:
-                    logger.warning(f"Failed to cleanup {temp_path}: {e}")
-                    
     except subprocess.TimeoutExpired:
         logger.error("OpenSCAD render timeout")
         return "Render timeout - script may be too complex"
     except Exception as e:
-        logger.error(f"Error during render: {e}")
+        logger.error("Error during render: %s", e)
         return f"Render error: {e}"
 
 @mcp.tool()
-def export_model_to_stl(filename: str) -> str:
-    """Export the current OpenSCAD script to STL file
+async def export_model_to_stl(filename: str, preview: bool = False, fn: int = 0) -> str:
+    """Export the current OpenSCAD script to a binary STL file
     
     Args:
         filename: Output filename (without .stl extension)
+        preview: Quick export; sets the global $fn to 32 unless fn is given
+            (per-call $fn arguments still win)
+        fn: Set the global $fn for the export, replacing the script's own
+            $fn/$fa/$fs resolution; per-call $fn arguments still win
+            (0 keeps the script's own value)
     """
     try:
-        if not state.script_content.strip():
+        if fn < 0:
+            return "fn must be zero or a positive number of fragments"
+        if preview and not fn:
+            fn = PREVIEW_FN
+        
+        script_content = state.script_content
+        if not script_content.strip():
             return "No script content to export"
         
         # Ensure filename doesn't have extension and add .stl
         filename = filename.replace('.stl', '') + '.stl'
         stl_path = WORK_DIR / filename
         
-        # Create temporary SCAD file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.scad', delete=False) as scad_file:
-            scad_file.write(state.script_content)
-            scad_path = scad_file.name
+        # Pipe the script in on stdin and write the STL straight to WORK_DIR
+        args = ['--render']
+        if fn:
+            args += ['-D', f'$fn={fn}']
+        args += ['--export-format=binstl', '-o', str(stl_path), '-']
+        result = await run_openscad(args, timeout=60, input=script_content.encode('utf-8'))
+        
+        if result.returncode != 0:
+            error_msg = f"OpenSCAD export error: {result.stderr}"
+            logger.error(error_msg)
+            return error_msg
+        
+        if not stl_path.exists():
+            return "Export failed: No STL file generated"
+        
+        file_size = stl_path.stat().st_size
+        logger.info("STL exported successfully: %s (%d bytes)", stl_path, file_size)
+        return f"STL exported successfully to {stl_path} ({file_size} bytes)"
         
-        try:
-            # Run OpenSCAD to generate STL
-            cmd = [
-                'openscad',
-                '--render',
-                '-o', str(stl_path),
-                scad_path
-            ]
-            
-            logger.info(f"Exporting STL: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            
-            if result.returncode != 0:
-                error_msg = f"OpenSCAD export error: {result.stderr}"
-                logger.error(error_msg)
-                return error_msg
-            
-            if not stl_path.exists():
-                return "Export failed: No STL file generated"
-            
-            file_size = stl_path.stat().st_size
-            logger.info(f"STL exported successfully: {stl_path} ({file_size} bytes)")
-            return f"STL exported successfully to {stl_path} ({file_size} bytes)"
-            
-        finally:
-            # Cleanup temporary SCAD file
-            try:
-                if Path(scad_path).exists():
-                    os.unlink(scad_path)
-            except Exception as e:
-                logger.warning(f"Failed to cleanup {scad_path}: {e}")
-                
     except subprocess.TimeoutExpired:
         logger.error("OpenSCAD export timeout")
         return "Export timeout - script may be too complex"
     except Exception as e:
-        logger.error(f"Error during export: {e}")
+        logger.error("Error during export: %s", e)
         return f"Export error: {e}"
 
 @mcp.tool()
@@ -256,30 +489,48 @@ def save_openscad_script(filename: str) -> str:
         with open(script_path, 'w') as f:
             f.write(state.script_content)
         
-        lines = len(state.script_content.split('\n'))
-        logger.info(f"Script saved: {script_path} ({lines} lines)")
+        lines = _line_count(state.script_content)
+        logger.info("Script saved: %s (%d lines)", script_path, lines)
         return f"Script saved to {script_path} ({lines} lines)"
         
     except Exception as e:
-        logger.error(f"Error saving script: {e}")
+        logger.error("Error saving script: %s", e)
         return f"Save error: {e}"
 
+def warm_up_openscad():
+    """Do a throwaway render so shared libraries and fonts are warm for the first real one"""
+    start = time.perf_counter()
+    try:
+        result = asyncio.run(run_openscad(
+            ['--imgsize=64,64', '--render', '--export-format=png', '-o', '-', '-'],
+            timeout=10, input=b'cube(1);'
+        ))
+    except Exception as e:
+        logger.warning("OpenSCAD warm-up render failed: %s", e)
+        return
+    
+    elapsed = time.perf_counter() - start
+    if result.returncode == 0:
+        logger.info("OpenSCAD warm-up render took %.2fs", elapsed)
+    else:
+        logger.warning("OpenSCAD warm-up render failed after %.2fs: %s", elapsed, result.stderr)
+
 def main():
     """Run the MCP server"""
     logger.info("Starting OpenSCAD MCP Server")
-    logger.info(f"Working directory: {WORK_DIR}")
-    logger.info(f"State file: {STATE_FILE}")
+    logger.info("Working directory: %s", WORK_DIR)
+    logger.info("Scratchpad file: %s", SCRIPT_FILE)
     
-    # Test OpenSCAD availability
+    # Test OpenSCAD availability; this also pulls the binary into the page cache
     try:
-        result = subprocess.run(['openscad', '--version'], 
-                              capture_output=True, text=True, timeout=5)
+        result = asyncio.run(run_openscad(['--version'], timeout=5))
         if result.returncode == 0:
             logger.info("OpenSCAD is available")
+            warm_up_openscad()
         else:
             logger.warning("OpenSCAD may not be properly installed")
     except Exception as e:
-        logger.error(f"OpenSCAD not found: {e}")
+        logger.error("OpenSCAD not found: %s", e)
     
     # Run the server
     mcp.run()